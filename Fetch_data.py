@@ -1,10 +1,26 @@
 import json
 import requests
-import pandas as pd
+import urllib3
+import numpy as np
 import os
-import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-import io
+import pyarrow as pa
+import pyarrow.dataset as ds
+import fetch_utils
+from fetch_utils import csv_column_types, create_session, parse_csv, get_streamed
+
+logger = logging.getLogger(__name__)
+
+# Threads used to fetch sites concurrently
+max_workers = 16
+
+# Parsed responses are cached here so reruns skip the network; data_ingestion.py keeps its own
+cache_dir = os.path.join('cache', 'fetch_data')
+
+# Every site is written with this schema, whatever columns its response happened to contain
+output_schema = pa.schema(list(csv_column_types.items()))
 
 def extract_site_ids(json_file):
     """Extract site IDs from the JSON file"""
@@ -14,89 +30,96 @@ def extract_site_ids(json_file):
     site_ids = [site['id'] for site in data if 'id' in site]
     return site_ids
 
-def construct_api_url(site_id, params, start_date, end_date):
-    """Construct the API URL with the given parameters"""
+# Shared by every fetch in this process so connections stay alive across sites
+_session = create_session({
+    'Accept': '*/*',  # Accept any content type
+    'User-Agent': 'Python/3.x Data Collection Script'
+}, pool_size=max_workers)
+
+def conform_to_schema(table):
+    """Return the table with exactly the known output columns, adding any missing ones as nulls"""
+    extra = [name for name in table.column_names if name not in output_schema.names]
+    if extra:
+        logger.warning("Dropping columns not in the output schema: %s", extra)
+    columns = [
+        table[field.name].cast(field.type) if field.name in table.column_names else pa.nulls(table.num_rows, field.type)
+        for field in output_schema
+    ]
+    return pa.Table.from_arrays(columns, schema=output_schema)
+
+def save_error_response(head, suffix):
+    """Save the start of a response that could not be parsed, for inspection"""
+    # The body has been consumed by the parser, so only its first bytes are kept
+    error_file = f"error_response_{datetime.now().strftime('%Y%m%d_%H%M%S')}{suffix}"
+    with open(error_file, 'wb') as f:
+        f.write(head)
+    logger.warning("Saved start of error response to %s", error_file)
+
+def construct_url_tail(params, start_date, end_date):
+    """Build the part of the API URL that is the same for every site"""
     params_str = ','.join(params)
-    url = f"http://atmos.urbansciences.in/adp/v4/getDeviceDataParam/imei/{site_id}/params/{params_str}/startdate/{start_date}/enddate/{end_date}/ts/mm/avg/15/api/63h3AckbgtY?gaps=1&gap_value=NaN"
-    return url
-
-def fetch_data_as_csv(url, max_retries=3):
+    return f"/params/{params_str}/startdate/{start_date}/enddate/{end_date}/ts/mm/avg/15/api/63h3AckbgtY?gaps=1&gap_value=NaN"
+
+def construct_api_url(site_id, url_tail):
+    """Construct the API URL for a site from the precomputed tail"""
+    return f"http://atmos.urbansciences.in/adp/v4/getDeviceDataParam/imei/{site_id}{url_tail}"
+
+def read_response(response, body):
+    """Parse a streamed response body as CSV (an Arrow Table) or JSON, whichever it starts like"""
+    # Log response info for debugging
+    content_type = response.headers.get('Content-Type', 'unknown')
+    logger.debug("Response status: %s", response.status_code)
+    logger.debug("Response content type: %s", content_type)
+    logger.debug("Response length: %s bytes", response.headers.get('Content-Length', 'unknown'))
+
+    # Peek at the start of the body without consuming it
+    head = body.peek(512)
+
+    # Check if response is empty
+    if not head.strip():
+        logger.debug("Empty response received")
+        return None
+
+    # The first bytes decide the format once: a JSON object/array, otherwise CSV.
+    # Either way the parser reads the stream directly; nothing is re-read on failure
+    is_json = head.lstrip()[:1] in (b'{', b'[')
+    try:
+        if is_json:
+            return json.load(body)
+        return parse_csv(body)
+    except (ValueError, pa.ArrowInvalid) as e:
+        logger.warning("Error parsing %s response: %s", 'JSON' if is_json else 'CSV', e)
+        save_error_response(head, '.txt' if is_json else '.csv')
+        return None
+
+def fetch_data_as_csv(url):
     """Fetch data from the API expecting CSV response format"""
-    headers = {
-        'Accept': '*/*',  # Accept any content type
-        'User-Agent': 'Python/3.x Data Collection Script'
-    }
-
-    for attempt in range(max_retries):
-        try:
-            response = requests.get(url, headers=headers, timeout=30)
-
-            # Check if the request was successful
-            response.raise_for_status()
-
-            # Log response info for debugging
-            content_type = response.headers.get('Content-Type', 'unknown')
-            print(f"Response status: {response.status_code}")
-            print(f"Response content type: {content_type}")
-            print(f"Response length: {len(response.text)} bytes")
-
-            # Check if response is empty
-            if not response.text.strip():
-                print("Empty response received")
-                return None
-
-            # If response is CSV, parse directly to DataFrame
-            if 'application/csv' in content_type or 'text/csv' in content_type or response.text.strip().startswith('dt_time,'):
-                print("Detected CSV format response")
-                try:
-                    # Use pandas to parse the CSV data
-                    df = pd.read_csv(io.StringIO(response.text))
-                    print(f"Successfully parsed CSV data with {len(df)} rows")
-                    return df
-                except Exception as e:
-                    print(f"Error parsing CSV data: {e}")
-                    # Save problematic response for inspection
-                    error_file = f"error_response_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
-                    with open(error_file, 'w') as f:
-                        f.write(response.text)
-                    print(f"Saved error response to {error_file}")
-                    return None
-
-            # If JSON content type or if we can't determine, try to parse as JSON
-            try:
-                data = response.json()
-                # Check if response indicates an error
-                if isinstance(data, dict) and 'message' in data and data.get('message') == 'unsuccessful':
-                    error_msg = data.get('error', 'Unknown error')
-                    print(f"API returned error: {error_msg}")
-                    return None
-                return data
-            except ValueError:
-                # Not JSON, try to parse as CSV as a fallback
-                try:
-                    df = pd.read_csv(io.StringIO(response.text))
-                    print(f"Successfully parsed as CSV (fallback) with {len(df)} rows")
-                    return df
-                except Exception as csv_err:
-                    print(f"Failed to parse response as JSON or CSV: {csv_err}")
-                    # Save problematic response
-                    error_file = f"error_response_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
-                    with open(error_file, 'w') as f:
-                        f.write(response.text)
-                    print(f"Saved error response to {error_file}")
-                    return None
-
-        except requests.exceptions.RequestException as e:
-            print(f"Attempt {attempt+1} failed: {e}")
-            if attempt < max_retries - 1:
-                wait_time = 2 * (attempt + 1)  # Exponential backoff
-                print(f"Retrying in {wait_time} seconds...")
-                time.sleep(wait_time)
-            else:
-                print(f"Failed to fetch data after {max_retries} attempts")
-                return None
+    try:
+        data = get_streamed(_session, url, read_response)
+    except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError) as e:
+        # Retries with backoff are handled by the session adapter and get_streamed, so this is the final failure
+        logger.warning("Failed to fetch data: %s", e)
+        return None
+
+    if isinstance(data, pa.Table):
+        logger.debug("Successfully parsed CSV data with %s rows", data.num_rows)
+        return data
+
+    # Check if response indicates an error
+    if isinstance(data, dict) and 'message' in data and data.get('message') == 'unsuccessful':
+        error_msg = data.get('error', 'Unknown error')
+        logger.warning("API returned error: %s", error_msg)
+        return None
+    return data
+
+def fetch_with_cache(url):
+    """Return the cached table for this URL if it is fresh, otherwise fetch and cache it"""
+    return fetch_utils.fetch_with_cache(url, fetch_data_as_csv, cache_dir)
 
 def main():
+    # Per-request details are logged at DEBUG, so only warnings from the workers are shown
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
     # Configuration
     json_file = 'site_ids.json'
     params = ["pm2.5cnc", "pm10cnc"]  # Parameters to fetch
@@ -105,68 +128,87 @@ def main():
     start_date = "2023-12-29T00:00"
     end_date = "2024-12-31T00:00"
 
-    # Create output directory
-    output_dir = 'air_quality_data'
+    # Create output directory; a directory of its own, since older runs left air_quality_data.csv
+    # inside air_quality_data/ and a dataset reader would trip over it
+    output_dir = 'air_quality_dataset'
     os.makedirs(output_dir, exist_ok=True)
 
     # Get site IDs from JSON file
     site_ids = extract_site_ids(json_file)
     print(f"Found {len(site_ids)} site IDs")
 
-    # Dictionary to store DataFrames for each site
-    site_data = {}
+    # Each site's table is written into a Hive-partitioned dataset (deviceid=<id>/) as it arrives,
+    # so only one site is held in memory and readers can load single sites
+    partitioning = ds.partitioning(pa.schema([('deviceid', csv_column_types['deviceid'])]), flavor='hive')
+    total_rows = 0
     successful_sites = 0
     failed_sites = 0
 
-    # Process each site ID
-    for i, site_id in enumerate(site_ids):
-        print(f"\nProcessing site {i+1}/{len(site_ids)}: {site_id}")
-
-        # Construct API URL
-        url = construct_api_url(site_id, params, start_date, end_date)
-        print(f"URL: {url}")
+    # Build the list of (site_id, url) jobs up front; only the site ID varies between URLs
+    url_tail = construct_url_tail(params, start_date, end_date)
+    jobs = [(site_id, construct_api_url(site_id, url_tail)) for site_id in site_ids]
 
-        # Fetch data (expecting CSV format)
-        data = fetch_data_as_csv(url)
+    # Fetch all sites concurrently; the rate limiter keeps the API from being overwhelmed
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(fetch_with_cache, url): site_id for site_id, url in jobs}
 
-        if data is not None:
-            if isinstance(data, pd.DataFrame):
-                # Ensure 'site_id' column exists
-                if 'deviceid' not in data.columns:
-                    data['deviceid'] = site_id
+        for i, future in enumerate(as_completed(futures)):
+            site_id = futures[future]
+            print(f"\nFinished site {i+1}/{len(site_ids)}: {site_id}")
 
-                # Store the DataFrame
-                site_data[site_id] = data
-                successful_sites += 1
-
-                # Just log the number of rows collected
-                print(f"Collected {len(data)} rows of data for {site_id}")
+            try:
+                data = future.result()
+            except Exception as e:
+                print(f"Error fetching data for {site_id}: {e}")
+                data = None
+
+            if data is not None:
+                if isinstance(data, pa.Table):
+                    # Ensure 'site_id' column exists
+                    if 'deviceid' not in data.column_names:
+                        indices = pa.array(np.zeros(data.num_rows, dtype=np.int32))
+                        data = data.append_column('deviceid', pa.DictionaryArray.from_arrays(indices, pa.array([site_id])))
+
+                    # Conform to the fixed output schema so every site has the same columns, whatever order they finish in
+                    try:
+                        data = conform_to_schema(data)
+                        ds.write_dataset(
+                            data,
+                            output_dir,
+                            format='parquet',
+                            partitioning=partitioning,
+                            basename_template=f"{site_id}-{{i}}.parquet",
+                            existing_data_behavior='overwrite_or_ignore',
+                            file_options=ds.ParquetFileFormat().make_write_options(compression='zstd'),
+                        )
+                    except pa.ArrowInvalid as e:
+                        print(f"Could not convert data for {site_id} to the output schema: {e}")
+                        failed_sites += 1
+                        continue
+
+                    successful_sites += 1
+                    total_rows += data.num_rows
+
+                    # Just log the number of rows collected
+                    print(f"Collected {data.num_rows} rows of data for {site_id}")
+                else:
+                    print(f"Unexpected data type for {site_id}: {type(data)}")
+                    failed_sites += 1
             else:
-                print(f"Unexpected data type for {site_id}: {type(data)}")
+                print(f"No data retrieved for {site_id}")
                 failed_sites += 1
-        else:
-            print(f"No data retrieved for {site_id}")
-            failed_sites += 1
-
-        # Wait between requests to avoid overwhelming the API
-        if i < len(site_ids) - 1:  # Don't wait after the last request
-            time.sleep(1)
-
-    # Create combined dataset if we have data
-    if site_data:
-        # Combine all dataframes
-        all_data = pd.concat(site_data.values(), ignore_index=True)
-
-        # Save to a single CSV file
-        output_file = f"{output_dir}/air_quality_data.csv"
-        all_data.to_csv(output_file, index=False)
 
+    # Report on the combined dataset if we have data
+    if successful_sites:
         print(f"\nSummary:")
         print(f"Total sites processed: {len(site_ids)}")
         print(f"Successful sites: {successful_sites}")
         print(f"Failed sites: {failed_sites}")
-        print(f"Total rows collected: {len(all_data)}")
-        print(f"All data saved to: {output_file}")
+        print(f"Total rows collected: {total_rows}")
+        print(f"All data saved to: {output_dir} (partitioned by deviceid)")
+        # The analysis notebooks still expect a single air_quality_data.csv; this loads the dataset instead
+        print(f"Load it with: import pyarrow.dataset as ds; "
+              f"ds.dataset('{output_dir}', format='parquet', partitioning='hive').to_table().to_pandas()")
     else:
         print("\nNo data was collected from any site.")
 
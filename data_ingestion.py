@@ -1,9 +1,21 @@
 import json
 import requests
-import pandas as pd
+import urllib3
 import os
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-import io
+import pyarrow as pa
+import fetch_utils
+from fetch_utils import create_session, parse_csv, get_streamed
+
+logger = logging.getLogger(__name__)
+
+# Concurrency settings for fetching sites
+max_workers = 16
+
+# Parsed responses are cached here so reruns skip the network; Fetch_data.py keeps its own
+cache_dir = os.path.join('cache', 'data_ingestion')
 
 # Load site IDs from site_ids.json
 def load_site_ids(json_file):
@@ -12,53 +24,81 @@ def load_site_ids(json_file):
     site_ids = [site['id'] for site in data if 'id' in site]
     return site_ids
 
-# Construct API URL
-def construct_api_url(site_id, params, start_date, end_date):
+# Build the part of the API URL that is the same for every site
+def construct_url_tail(params, start_date, end_date):
     params_str = ",".join(params)
-    url = f"http://atmos.urbansciences.in/adp/v4/getDeviceDataParam/imei/{site_id}/params/{params_str}/startdate/{start_date}/enddate/{end_date}/ts/mm/avg/15/api/63h3AckbgtY?gaps=1&gap_value=NaN"
-    return url
+    return f"/params/{params_str}/startdate/{start_date}/enddate/{end_date}/ts/mm/avg/15/api/63h3AckbgtY?gaps=1&gap_value=NaN"
+
+# Construct API URL
+def construct_api_url(site_id, url_tail):
+    return f"http://atmos.urbansciences.in/adp/v4/getDeviceDataParam/imei/{site_id}{url_tail}"
+
+# Shared by every fetch in this process so connections stay alive across sites
+_session = create_session({'Accept': 'text/csv'}, pool_size=max_workers)
 
-# Fetch data from API
+# Stream a response body into pyarrow, or None if it is empty
+def read_csv_body(response, body):
+    if not body.peek(512).strip():  # Handle empty responses
+        logger.debug("Empty response from API")
+        return None
+    return parse_csv(body)
+
+# Fetch data from API as an Arrow Table
 def fetch_data(api_url):
-    headers = {'Accept': 'text/csv'}
     try:
-        response = requests.get(api_url, headers=headers, timeout=30)
-        response.raise_for_status()  # Raise HTTPError for bad responses (4xx, 5xx)
-        
-        if not response.text.strip():  # Handle empty responses
-            print("Empty response from API")
-            return None
-
-        # Use io.StringIO for CSV parsing
-        return pd.read_csv(io.StringIO(response.text))
-    except requests.exceptions.RequestException as e:
-        print(f"Request failed: {e}")
+        return get_streamed(_session, api_url, read_csv_body)
+    except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError) as e:
+        logger.warning("Request failed: %s", e)
         return None
-    except pd.errors.EmptyDataError:
-        print("No data to parse in CSV response.")
+    except pa.ArrowInvalid as e:
+        logger.warning("Could not parse CSV response: %s", e)
         return None
 
-# Store data to CSV
+# Return the cached data for this URL if it is fresh, otherwise fetch and cache it;
+# converted to pandas at the boundary
+def fetch_with_cache(api_url):
+    table = fetch_utils.fetch_with_cache(api_url, fetch_data, cache_dir)
+    return table.to_pandas() if table is not None else None
+
+# Store data to Parquet
 def save_data(df, site_id, output_dir='data'):
     os.makedirs(output_dir, exist_ok=True)
-    file_path = os.path.join(output_dir, f"{site_id}_data.csv")
-    df.to_csv(file_path, index=False)
+    file_path = os.path.join(output_dir, f"{site_id}_data.parquet")
+    df.to_parquet(file_path, engine='pyarrow', compression='zstd', index=False)
     print(f"Data saved to {file_path}")
 
 # Main function
 def main(json_file, start_date, end_date, params=["pm2.5cnc", "pm10cnc"]):
+    # Per-request details are logged at DEBUG, so only warnings from the workers are shown
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
     site_ids = load_site_ids(json_file)
     print(f"Found {len(site_ids)} site IDs.")
     
-    for site_id in site_ids:
-        print(f"Fetching data for site ID: {site_id}")
-        api_url = construct_api_url(site_id, params, start_date, end_date)
-        data = fetch_data(api_url)
-        
-        if data is not None and not data.empty:
-            save_data(data, site_id)
-        else:
-            print(f"No data retrieved for site ID: {site_id}")
+    url_tail = construct_url_tail(params, start_date, end_date)
+    jobs = [(site_id, construct_api_url(site_id, url_tail)) for site_id in site_ids]
+
+    # Fetch sites concurrently, saving each one as soon as it arrives
+    failed_sites = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(fetch_with_cache, api_url): site_id for site_id, api_url in jobs}
+        for future in as_completed(futures):
+            site_id = futures[future]
+            # One site failing must not stop the remaining sites from being saved
+            try:
+                data = future.result()
+            except Exception as e:
+                print(f"Error fetching data for site ID: {site_id}: {e}")
+                failed_sites += 1
+                continue
+
+            if data is not None and not data.empty:
+                save_data(data, site_id)
+            else:
+                print(f"No data retrieved for site ID: {site_id}")
+                failed_sites += 1
+
+    print(f"Failed sites: {failed_sites} of {len(site_ids)}")
 
 # Set parameters
 json_file = 'site_ids.json'
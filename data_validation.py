@@ -1,51 +1,154 @@
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import os
+from concurrent.futures import ProcessPoolExecutor
 
 # Path to data folder
 data_dir = 'data'
 
-# List all CSV files
-csv_files = [f for f in os.listdir(data_dir) if f.endswith('.csv')]
-print(f"Found {len(csv_files)} CSV files.")
+# Pollutant columns to clean
+value_cols = ['pm2.5cnc', 'pm10cnc']
 
-# Clean and validate each CSV
-for file in csv_files:
-    file_path = os.path.join(data_dir, file)
-    print(f"\nProcessing {file}...")
+# Time-weighted interpolation of NaN gaps, done in place on a 2D float array.
+# np.interp holds the first/last valid value beyond the ends, which matches interpolate(method='time').ffill().bfill().
+# anchors optionally gives, per column, the (time, value) of the last valid point before these rows
+def fill_gaps(times, values, anchors=None):
+    for j in range(values.shape[1]):
+        col = values[:, j]
+        missing = np.isnan(col)
+        if not missing.any():
+            continue
+        valid_times = times[~missing]
+        valid_values = col[~missing]
+        if anchors is not None and anchors[j] is not None:
+            valid_times = np.concatenate(([anchors[j][0]], valid_times))
+            valid_values = np.concatenate(([anchors[j][1]], valid_values))
+        if len(valid_times) == 0:
+            continue
+        order = np.argsort(valid_times, kind='stable')
+        col[missing] = np.interp(times[missing], valid_times[order], valid_values[order])
+    return values
+
+# Columns whose row-group statistics say every value is null; they can never be filled,
+# so they must not hold back rows while streaming
+def all_null_columns(pf):
+    metadata = pf.metadata
+    names = [metadata.schema.column(k).name for k in range(metadata.num_columns)]
+    result = set()
+    for col in value_cols:
+        if col not in names:
+            continue
+        k = names.index(col)
+        null_count = 0
+        for i in range(metadata.num_row_groups):
+            stats = metadata.row_group(i).column(k).statistics
+            if stats is None or not stats.has_null_count:
+                null_count = None
+                break
+            null_count += stats.null_count
+        if null_count == metadata.num_rows:
+            result.add(col)
+    return result
 
-    # Load CSV
-    df = pd.read_csv(file_path)
+# Clean and validate a single file; files are independent so this runs in worker processes.
+# The file is streamed in record batches so peak memory is one batch, not the whole file.
+# Streaming assumes rows are in time order (as fetched): a row is written once every fillable column
+# has a valid value at or after it, and the last written valid points anchor the next batch.
+# Files that are not in time order are read as a single batch and cleaned in one pass instead
+def clean_one(file_path, batch_size=200_000):
+    file = os.path.basename(file_path)
+    print(f"\nProcessing {file}...")
 
-    # Convert dt_time to datetime and set as index
-    if 'dt_time' in df.columns:
-        df['dt_time'] = pd.to_datetime(df['dt_time'], errors='coerce')
-        df.set_index('dt_time', inplace=True)
-    else:
+    pf = pq.ParquetFile(file_path)
+    if 'dt_time' not in pf.schema_arrow.names:
         print(f"Skipping {file} — 'dt_time' column not found.")
-        continue
+        return
+
+    # Only the timestamp column is loaded to check the ordering assumption
+    in_order = pq.read_table(file_path, columns=['dt_time'])['dt_time'].to_pandas().is_monotonic_increasing
+    if not in_order:
+        print(f"Warning: {file} is not in time order; cleaning it in one pass.")
+        batch_size = max(pf.metadata.num_rows, 1)
+
+    output_path = os.path.join(os.path.dirname(file_path), f"final_cleaned_{file}")
+    unfillable = all_null_columns(pf)
+    writer = None
+    missing_counts = None
+
+    # Rows that still have a gap with no valid value after it yet, and the last valid point per column before them
+    pending = None
+    anchors = [None] * len(value_cols)
+
+    # Fill the first `count` rows of frame (or all of it) and write them out
+    def flush(frame, count):
+        nonlocal writer, missing_counts
+        times = frame['dt_time'].to_numpy().astype(np.int64).astype(np.float64)
+        values = frame[value_cols].to_numpy(dtype=np.float32, copy=True)
+        fill_gaps(times, values, anchors)
 
-    # Handle full-column missing values
-    if df['pm2.5cnc'].isnull().all():
-        print(f"Warning: All values missing for 'pm2.5cnc' in {file}. Imputing with median...")
-        df['pm2.5cnc'].fillna(df['pm2.5cnc'].median(), inplace=True)
+        done = frame.iloc[:count].copy()
+        done[value_cols] = values[:count]
+        for j in range(len(value_cols)):
+            valid = np.flatnonzero(~np.isnan(values[:count, j]))
+            if len(valid):
+                anchors[j] = (times[valid[-1]], values[valid[-1], j])
 
-    if df['pm10cnc'].isnull().all():
-        print(f"Warning: All values missing for 'pm10cnc' in {file}. Imputing with median...")
-        df['pm10cnc'].fillna(df['pm10cnc'].median(), inplace=True)
+        table = pa.Table.from_pandas(done, preserve_index=False)
+        if writer is None:
+            writer = pq.ParquetWriter(output_path, table.schema, compression='zstd')
+        writer.write_table(table)
 
-    # Forward and backward fill
-    df.loc[:, 'pm2.5cnc'] = df['pm2.5cnc'].ffill().bfill()
-    df.loc[:, 'pm10cnc'] = df['pm10cnc'].ffill().bfill()
+        counts = done.drop(columns='dt_time').isnull().sum()
+        missing_counts = counts if missing_counts is None else missing_counts.add(counts, fill_value=0)
+        return frame.iloc[count:]
 
-    # Interpolation (time-based)
-    df.loc[:, 'pm2.5cnc'] = df['pm2.5cnc'].interpolate(method='time')
-    df.loc[:, 'pm10cnc'] = df['pm10cnc'].interpolate(method='time')
+    try:
+        for batch in pf.iter_batches(batch_size=batch_size):
+            frame = batch.to_pandas()
+            if pending is not None and len(pending):
+                frame = pd.concat([pending, frame], ignore_index=True)
 
-    # Save cleaned data
-    output_path = os.path.join(data_dir, f"final_cleaned_{file}")
-    df.reset_index().to_csv(output_path, index=False)
+            # Rows up to the last valid value of every fillable column can be completed now
+            # (an out-of-order file arrives as one batch and is completed in full)
+            ready = len(frame)
+            for col in value_cols:
+                if col in unfillable or not in_order:
+                    continue
+                valid = np.flatnonzero(frame[col].notna().to_numpy())
+                ready = min(ready, valid[-1] + 1 if len(valid) else 0)
+
+            pending = flush(frame, ready) if ready else frame
+
+        # Whatever is left has no later values; fill it from the last valid points (forward fill)
+        if pending is not None and len(pending):
+            flush(pending, len(pending))
+    finally:
+        if writer is not None:
+            writer.close()
+
+    if writer is None:
+        print(f"Skipping {file} — no rows found.")
+        return
     print(f"Cleaned data saved to {output_path}")
 
     # Check for remaining missing values
-    print("\nRemaining missing values after cleaning:")
-    print(df.isnull().sum())
+    print(f"\nRemaining missing values after cleaning {file}:")
+    print(missing_counts.astype(int))
+
+def main():
+    # List all Parquet files, skipping the cleaned outputs of earlier runs
+    with os.scandir(data_dir) as entries:
+        file_paths = [
+            entry.path for entry in entries
+            if entry.is_file() and entry.name.endswith('.parquet') and not entry.name.startswith('final_cleaned_')
+        ]
+    print(f"Found {len(file_paths)} Parquet files.")
+
+    # Clean files in parallel across all cores
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        list(executor.map(clean_one, file_paths))
+
+if __name__ == "__main__":
+    main()
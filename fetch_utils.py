@@ -0,0 +1,122 @@
+"""HTTP session, rate limiting, retries and response cache shared by Fetch_data.py and data_ingestion.py"""
+import io
+import os
+import time
+import hashlib
+import logging
+import threading
+import requests
+import urllib3
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pyarrow import csv as pacsv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+# Upper bound on requests per second sent to the API across all threads, retries included
+max_requests_per_second = 4
+
+# Extra attempts when the connection drops while the response body is being read
+body_read_retries = 2
+
+# Parsed responses are cached as Parquet tables so reruns skip the network
+cache_max_age = 24 * 3600  # seconds
+
+# Known column types of the CSV returned by the API, so the reader never has to infer them
+csv_column_types = {
+    'dt_time': pa.timestamp('ns'),
+    'pm2.5cnc': pa.float32(),
+    'pm10cnc': pa.float32(),
+    # One dictionary entry per site instead of a string per row (a pandas category after to_pandas)
+    'deviceid': pa.dictionary(pa.int32(), pa.string()),
+}
+
+_rate_lock = threading.Lock()
+_next_request_time = 0.0
+
+def wait_for_rate_limit(requests_per_second=max_requests_per_second):
+    """Block until the shared rate limit allows another request"""
+    global _next_request_time
+    with _rate_lock:
+        now = time.monotonic()
+        wait_time = _next_request_time - now
+        _next_request_time = max(now, _next_request_time) + 1.0 / requests_per_second
+    if wait_time > 0:
+        time.sleep(wait_time)
+
+class RateLimitedRetry(Retry):
+    """urllib3 Retry that also takes a slot from the shared rate limiter before each re-sent request"""
+    def sleep(self, response=None):
+        super().sleep(response)
+        wait_for_rate_limit()
+
+def create_session(headers, pool_size, max_retries=3):
+    """Create a requests Session whose connection pool is shared by all worker threads"""
+    # The API is served over plain http://, where HTTP/2 is not negotiated (clients only get it via TLS ALPN),
+    # so concurrency comes from a keep-alive HTTP/1.1 pool with one connection per worker
+    session = requests.Session()
+    session.headers.update(headers)
+    # Retry failed connections and transient server errors with exponential backoff inside urllib3;
+    # re-sent requests go through the rate limiter too, so retries cannot exceed max_requests_per_second
+    retry = RateLimitedRetry(
+        total=max_retries,
+        backoff_factor=2,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=['GET'],
+    )
+    # Every request goes to the same host, so one pool holding a connection per worker is enough
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def parse_csv(source):
+    """Parse a binary CSV stream into an Arrow Table with the multithreaded Arrow reader"""
+    return pacsv.read_csv(
+        source,
+        read_options=pacsv.ReadOptions(use_threads=True, block_size=8 << 20),
+        convert_options=pacsv.ConvertOptions(column_types=csv_column_types),
+    )
+
+def get_streamed(session, url, read_body, timeout=30):
+    """GET url and return read_body(response, body), where body is a buffered byte stream of the response"""
+    # The adapter's Retry only covers connecting and the status line. With stream=True, a connection
+    # dropped while read_body parses the body raises here instead, so the whole request is re-sent
+    # (without sleeping: these are not server errors, and the adapter handles backoff for those).
+    # Once the attempts run out the error is raised to the caller like any other request failure
+    for attempt in range(body_read_retries + 1):
+        try:
+            wait_for_rate_limit()
+            with session.get(url, timeout=timeout, stream=True) as response:
+                response.raise_for_status()
+                # Decode gzip/deflate transparently; callers can peek at the start without consuming it
+                response.raw.decode_content = True
+                response.raw.auto_close = False  # let BufferedReader drain its buffer after EOF
+                body = io.BufferedReader(response.raw, buffer_size=64 * 1024)
+                return read_body(response, body)
+        except (urllib3.exceptions.ProtocolError, urllib3.exceptions.ReadTimeoutError) as e:
+            if attempt == body_read_retries:
+                raise
+            logger.warning("Connection lost while reading response, retrying (%s/%s): %s", attempt + 1, body_read_retries, e)
+
+def fetch_with_cache(url, fetch, cache_dir):
+    """Return the cached table for this URL if it is fresh, otherwise call fetch(url) and cache its table"""
+    key = hashlib.sha1(url.encode()).hexdigest()
+    cache_file = os.path.join(cache_dir, f"{key}.parquet")
+
+    if os.path.exists(cache_file) and time.time() - os.path.getmtime(cache_file) < cache_max_age:
+        logger.debug("Loaded cached response from %s", cache_file)
+        return pq.read_table(cache_file)
+
+    data = fetch(url)
+
+    # Only Arrow tables are cached; write then rename so concurrent readers never see a partial file
+    if isinstance(data, pa.Table):
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_file = f"{cache_file}.{threading.get_ident()}.tmp"
+        pq.write_table(data, tmp_file, compression='zstd')
+        os.replace(tmp_file, cache_file)
+
+    return data